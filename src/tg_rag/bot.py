@@ -1,19 +1,30 @@
 import asyncio
+import contextlib
 import logging
 import os
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+from datetime import timedelta
+from itertools import batched
 
-import dotenv
 from anyio import Path
+from langchain_community.cache import SQLiteCache
 from langchain_core.documents import Document
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.globals import set_llm_cache
+from langchain_core.load import dumps
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration
 from langchain_openai.chat_models import ChatOpenAI
 from telegram import Message, Update
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, filters
 
+from tg_rag.config import OPENAI_API_BASE_URL, OPENAI_API_KEY, TELEGRAM_BOT_TOKEN
 from tg_rag.utils import (
     cleanup_file,
     configure_qdrant,
     configure_retriever,
+    format_context,
     parse_document,
     restrict_to_user_id,  # type: ignore
     update_store,
@@ -25,41 +36,64 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-dotenv.load_dotenv(dotenv_path=dotenv.find_dotenv(raise_error_if_not_found=True))
-
 CLIENT, VECTOR_STORE = configure_qdrant()
 RETIREVER = configure_retriever(vector_store=VECTOR_STORE)
 UPLOAD_DIR = Path("uploads")
+os.makedirs(UPLOAD_DIR, exist_ok=True)
 MODEL_NAME = 'qwen2-7b-instruct'
-COLLECTION_NAME = os.getenv("COLLECTION_NAME", "tg-store")
-uuids: list[str] = []
+LLM_CACHE_PATH = ".tg_rag_llm_cache.db"
+RETRIEVAL_CACHE_SIZE = 256
+STREAM_EDIT_INTERVAL = 1.0  # seconds between Telegram message edits while streaming, ~Telegram's per-chat limit
+DELETE_BATCH_SIZE = 256
+uuids: set[str] = set()
+retrieval_cache: dict[str, list[Document]] = {}
+
+LLM_CACHE = SQLiteCache(database_path=LLM_CACHE_PATH)
+set_llm_cache(LLM_CACHE)
+
+
+def configure_llm() -> ChatOpenAI:
+    """Configure and return the OpenAI-compatible chat model shared by all requests."""
+    return ChatOpenAI(
+        base_url=OPENAI_API_BASE_URL,
+        api_key=OPENAI_API_KEY,  # type: ignore
+        model=MODEL_NAME,
+        timeout=60,
+        max_retries=2,
+        max_tokens=512,
+        temperature=0.2,
+        top_p=0.9,
+        stop=["\n\nQuestion:"],
+    )
+
+
+LLM = configure_llm()
 
 
 @restrict_to_user_id
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Main handler for incoming messages."""
-    if not update.message:
+    message = update.message
+    if not message:
         return
 
-    if update.message.text and update.message.text.startswith("RESET"):
-        await handle_reset(update.message)
+    text = message.text
+    if text and (command_handler := COMMAND_HANDLERS.get((text.split(maxsplit=1) or [""])[0])):
+        await command_handler(message)
         return
 
-    if update.message and not update.message.document:
-        await handle_text_message(update.message)
+    if message.document:
+        await handle_file_upload(message)
         return
 
-    if update.message.document:
-        await handle_file_upload(update.message)
-        return
+    await handle_text_message(message)
+
 
 async def handle_reset(message: Message) -> None:
     """Handle the RESET command to clear the vector store."""
-    global uuids
     try:
         logger.info("Resetting the vector store...")
-        if uuids and VECTOR_STORE.delete(uuids):  # type: ignore
-            uuids = []
+        if uuids and await delete_from_store(uuids):
             logger.info("Vector store reset successfully.")
             await message.reply_text("Vector store reset successfully.")
         else:
@@ -70,6 +104,26 @@ async def handle_reset(message: Message) -> None:
         await message.reply_text(f"An error occurred while resetting the vector store: {e}")
 
 
+COMMAND_HANDLERS: dict[str, Callable[[Message], Awaitable[None]]] = {
+    "RESET": handle_reset,
+}
+
+
+async def delete_from_store(ids: set[str]) -> bool:
+    """Delete the given ids from the vector store in batches, dropping each deleted batch from the set."""
+    deleted_any = False
+    try:
+        for batch in batched(list(ids), DELETE_BATCH_SIZE):
+            if not await VECTOR_STORE.adelete(ids=list(batch)):
+                return False
+            ids.difference_update(batch)
+            deleted_any = True
+        return True
+    finally:
+        if deleted_any:
+            retrieval_cache.clear()
+
+
 async def handle_text_message(message: Message) -> None:
     """Handle text messages from the user."""
     user_message = message.text
@@ -77,44 +131,87 @@ async def handle_text_message(message: Message) -> None:
         await message.reply_text("Please send a valid text message.")
         return
 
+    ack_task = asyncio.create_task(message.reply_text("🔎 Searching…"))
     try:
         logger.info("Retrieving documents for user query: %s", user_message)
-        retrieved_docs = RETIREVER.invoke(user_message)
+        retrieved_docs = await retrieve_documents(user_message)
+        sent = await ack_task
         if not retrieved_docs:
-            await message.reply_text("No relevant documents found for your query.")
+            await sent.edit_text("No relevant documents found for your query.")
             return
 
         logger.info("Asking OpenAI LLM about the retrieved documents...")
-        response = await query_openai_llm(user_message, retrieved_docs)
-        await message.reply_text(f"LLM's response: {response}")
+        # Telegram strips trailing whitespace, so an edit that only adds whitespace fails as "not modified"
+        shown = sent.text
+        response = ""
+        last_edit = time.monotonic()
+        async for chunk in query_openai_llm(user_message, retrieved_docs):
+            response += chunk
+            text = f"LLM's response: {response}".rstrip()
+            if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL and response.strip() and text != shown:
+                # Intermediate edits are cosmetic, so Telegram errors must not discard the answer
+                last_edit = time.monotonic()
+                try:
+                    await sent.edit_text(text)
+                    shown = text
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    delay = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                    logger.warning("Telegram flood control hit while streaming, backing off for %s seconds.", delay)
+                    last_edit += delay
+                except TelegramError as e:
+                    logger.warning("Failed to update the streamed response: %s", e)
+
+        final = f"LLM's response: {response}".rstrip()
+        if final != shown:
+            # Wait out any flood-control backoff so the final edit is not rejected as well
+            await asyncio.sleep(max(0.0, last_edit - time.monotonic()))
+            await sent.edit_text(final)
     except Exception as e:
         logger.error("Error while processing user query: %s, Error: %s", user_message, e)
-        await message.reply_text(f"An error occurred while processing your query: {e}")
-
+        error_text = f"An error occurred while processing your query: {e}"
+        sent = None
+        with contextlib.suppress(Exception):
+            sent = await ack_task
+        if sent:
+            await sent.edit_text(error_text)
+        else:
+            await message.reply_text(error_text)
 
-async def query_openai_llm(user_message: str, retrieved_docs: list[Document]) -> str:
-    """Query OpenAI LLM with the retrieved documents."""
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    openai_api_base_url = os.getenv("OPENAI_API_BASE_URL")
 
-    if not openai_api_base_url:
-        logger.error("OPENAI_API_BASE_URL environment variable is not set.")
-        raise ValueError("OpenAI API base URL is missing.")
-    if not openai_api_key:
-        logger.error("OPENAI_API_KEY environment variable is not set.")
-        raise ValueError("OpenAI API key is missing.")
+async def retrieve_documents(query: str) -> list[Document]:
+    """Retrieve documents for the query, reusing results until the vector store changes."""
+    if query not in retrieval_cache:
+        if len(retrieval_cache) >= RETRIEVAL_CACHE_SIZE:
+            retrieval_cache.pop(next(iter(retrieval_cache)))
+        retrieval_cache[query] = await RETIREVER.ainvoke(query)
+    else:
+        logger.info("Using cached retrieval results for query: %s", query)
+    return retrieval_cache[query]
 
-    model = ChatOpenAI(
-        base_url=openai_api_base_url,
-        model=MODEL_NAME
-    )
 
+async def query_openai_llm(user_message: str, retrieved_docs: list[Document]) -> AsyncIterator[str]:
+    """Query OpenAI LLM with the retrieved documents, yielding the response as it is generated."""
+    context = format_context(retrieved_docs)
     messages = [  # type: ignore
-        SystemMessage("You are a helpful assistant."),
-        HumanMessage(f"Based on these documents: {retrieved_docs}, answer the query: {user_message}")
+        SystemMessage(
+            "You are a helpful assistant. Answer the question using the provided context. Be concise: ≤6 sentences."
+        ),
+        HumanMessage(f"Context:\n{context}\n\nQuestion: {user_message}")
     ]
-    response = await model.ainvoke(messages)  # type: ignore
-    return response.text()
+    # astream() bypasses the LLM cache, so look it up with the same keys ainvoke() would use
+    prompt = dumps(messages)
+    llm_string = LLM._get_llm_string()  # type: ignore
+    if cached := await LLM_CACHE.alookup(prompt, llm_string):
+        logger.info("Using cached LLM response for query: %s", user_message)
+        yield cached[0].text
+        return
+
+    chunks: list[str] = []
+    async for chunk in LLM.astream(messages):  # type: ignore
+        chunks.append(chunk.text())
+        yield chunks[-1]
+    await LLM_CACHE.aupdate(prompt, llm_string, [ChatGeneration(message=AIMessage("".join(chunks)))])
 
 
 async def handle_file_upload(message: Message) -> None:
@@ -140,10 +237,9 @@ async def handle_file_upload(message: Message) -> None:
         await process_file(file_path, message)
     except Exception as e:
         logger.error("Error while processing file: %s, Error: %s", file_path, e)
-        await message.reply_text(f"An error occurred while processing the file: {e}")
         await cleanup_file(file_path)
         logger.info("File cleaned up: %s", file_path)
-        await message.reply_text("File cleaned up successfully.")
+        await message.reply_text(f"An error occurred while processing the file: {e}\nFile cleaned up successfully.")
 
 
 async def process_file(file_path: Path, message: Message) -> None:
@@ -151,28 +247,24 @@ async def process_file(file_path: Path, message: Message) -> None:
     logger.info("Parsing file: %s", file_path)
     docs = await parse_document(file_path)
     logger.info("File parsed successfully: %s", file_path)
-    uuid_docs_mapping = await update_store(VECTOR_STORE, docs)
-    await message.reply_text("File processed successfully! Here's a preview:\n")
-    for uuid, doc in uuid_docs_mapping.items():
-        await message.reply_text(f"- {uuid}: {doc.page_content[:100]}...\n")
-        break
+    try:
+        uuid_docs_mapping = await update_store(VECTOR_STORE, docs, uuids)
+    finally:
+        retrieval_cache.clear()
+    preview = "\n".join(f"- {uuid}: {doc.page_content[:100]}..." for uuid, doc in list(uuid_docs_mapping.items())[:3])
+    await message.reply_text(f"File processed successfully! Here's a preview:\n{preview}")
     logger.info("Documents added to vector store: %s", uuid_docs_mapping)
-    uuids.extend(uuid_docs_mapping.keys())  # type: ignore
 
 
 def main() -> None:
     """Start the bot."""
-    asyncio.gather(UPLOAD_DIR.mkdir(parents=True, exist_ok=True))
-    logger.info("Upload directory created: %s", UPLOAD_DIR)
-
-    bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not bot_token:
+    if not TELEGRAM_BOT_TOKEN:
         logger.critical("TELEGRAM_BOT_TOKEN environment variable is not set.")
         return
 
     logger.info("Bot is starting...")
     try:
-        app = ApplicationBuilder().token(bot_token).build()
+        app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
         logger.info("Setting up command handlers...")
         app.add_handler(MessageHandler(filters.ALL, handle_message))
 
@@ -0,0 +1,26 @@
+import logging
+import os
+
+import dotenv
+
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv(dotenv_path=dotenv.find_dotenv(raise_error_if_not_found=True))
+
+
+def _require_env(name: str) -> str:
+    """Return the value of a required environment variable or raise if it is not set."""
+    value = os.getenv(name)
+    if not value:
+        logger.error("%s environment variable is not set.", name)
+        raise ValueError(f"{name} environment variable is not set.")
+    return value
+
+
+AUTHORIZED_USER_ID: int = int(_require_env("ALLOWED_USER_ID"))
+OPENAI_API_KEY: str = _require_env("OPENAI_API_KEY")
+OPENAI_API_BASE_URL: str = _require_env("OPENAI_API_BASE_URL")
+TELEGRAM_BOT_TOKEN: str | None = os.getenv("TELEGRAM_BOT_TOKEN")
+COLLECTION_NAME: str = os.getenv("QDRANT_COLLECTION_NAME", "tg-store")
+QDRANT_URL: str | None = os.getenv("QDRANT_URL")
+QDRANT_GRPC_PORT: int = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
@@ -1,9 +1,10 @@
+import asyncio
 import logging
-import os
 from functools import wraps
 from typing import Any
 from uuid import uuid4
 
+import torch
 from anyio import Path
 from langchain_core.documents import Document
 from langchain_docling.loader import DoclingLoader
@@ -11,18 +12,38 @@ from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_qdrant import QdrantVectorStore
 from langchain_text_splitters import SentenceTransformersTokenTextSplitter
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams
+from qdrant_client.http.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    Distance,
+    QuantizationSearchParams,
+    SearchParams,
+    VectorParams,
+)
 from telegram import Update
 from telegram.ext import ContextTypes
 
+from tg_rag.config import AUTHORIZED_USER_ID, COLLECTION_NAME, QDRANT_GRPC_PORT, QDRANT_URL
+
 logger = logging.getLogger(__name__)
-COLLECTION_NAME = os.getenv("COLLECTION_NAME", "tg-store")
+UPLOAD_BATCH_SIZE = 64
+UPLOAD_CONCURRENCY = 2
+RETRIEVER_SEARCH_KWARGS: dict[str, Any] = {
+    "k": 5,
+    "score_threshold": 0.3,
+    "search_params": SearchParams(quantization=QuantizationSearchParams(rescore=True, oversampling=2.0)),
+}
+SPLITTER = SentenceTransformersTokenTextSplitter(
+    tokens_per_chunk=512,
+    chunk_overlap=50,
+    model_name="BAAI/bge-m3"
+)
 
 
 async def parse_document(file_path: str | Path) -> list[Document]:
     """Parse a document from the given file path."""
     logger.info("Parsing document from file: %s", file_path)
-    docs = await DoclingLoader(file_path=str(file_path)).aload()
+    docs = await asyncio.to_thread(DoclingLoader(file_path=str(file_path)).load)
     logger.info("Document parsing completed.")
     return docs
 
@@ -30,22 +51,37 @@ async def parse_document(file_path: str | Path) -> list[Document]:
 def configure_qdrant() -> tuple[QdrantClient, QdrantVectorStore]:
     """Configure and return a Qdrant client and vector store."""
     logger.info("Configuring Qdrant client and vector store...")
+    model_kwargs: dict[str, Any] = {"device": "cpu"}
+    if torch.cuda.is_available():
+        model_kwargs = {"device": "cuda", "model_kwargs": {"torch_dtype": torch.float16}}
+    logger.info("Loading embeddings model on device: %s", model_kwargs["device"])
     embeddings = HuggingFaceEmbeddings(
         model_name="BAAI/bge-m3",
-        encode_kwargs={'truncation': True, 'max_length': 512}
+        model_kwargs=model_kwargs,
+        encode_kwargs={'batch_size': 64, 'truncation': True, 'max_length': 512, 'normalize_embeddings': True}
     )
-    embeddings.embed_query("test")  # Warm up the model
-
-    client = QdrantClient(path='/tmp/langchain_qdrant')
+    # Warm up the model; kernel selection on CUDA depends on the shape, so use the real chunk batch there
+    if model_kwargs["device"] == "cuda":
+        embeddings.embed_documents(["x " * 512] * 32)
+    else:
+        embeddings.embed_query("test")
+
+    if QDRANT_URL:
+        logger.info("Connecting to Qdrant server at %s over gRPC", QDRANT_URL)
+        client = QdrantClient(url=QDRANT_URL, prefer_grpc=True, grpc_port=QDRANT_GRPC_PORT)
+    else:
+        logger.warning("QDRANT_URL is not set, falling back to embedded Qdrant storage.")
+        client = QdrantClient(path='/tmp/langchain_qdrant')
 
     # Create collection if it doesn't exist
-    try:
+    if client.collection_exists(collection_name=COLLECTION_NAME):
+        logger.info("Collection already exists. Skipping creation.")
+    else:
         client.create_collection(
             collection_name=COLLECTION_NAME,
             vectors_config=VectorParams(size=1024, distance=Distance.COSINE),
+            quantization_config=BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True)),
         )
-    except ValueError:
-        logger.info("Collection already exists. Skipping creation.")
 
     vector_store = QdrantVectorStore(
         client=client,
@@ -56,29 +92,83 @@ def configure_qdrant() -> tuple[QdrantClient, QdrantVectorStore]:
     return client, vector_store
 
 
-async def update_store(vector_store: QdrantVectorStore, docs: list[Document]) -> dict[str, Document]:
-    """Update the vector store with the given documents."""
+async def update_store(
+    vector_store: QdrantVectorStore, docs: list[Document], stored_ids: set[str]
+) -> dict[str, Document]:
+    """Update the vector store with the given documents, adding the ids of every uploaded batch to `stored_ids`."""
     logger.info("Splitting documents into chunks...")
-    splitter = SentenceTransformersTokenTextSplitter(
-        tokens_per_chunk=512,
-        chunk_overlap=50,
-        model_name="BAAI/bge-m3"
-    )
-    splitted_docs = splitter.split_documents(docs)
+    splitted_docs = await asyncio.to_thread(SPLITTER.split_documents, docs)
     logger.info("Document splitting completed.")
 
-    ids = [str(uuid4()) for _ in splitted_docs]
+    ids = [uuid4().hex for _ in splitted_docs]
     logger.info("Adding documents to vector store...")
-    await vector_store.aadd_documents(documents=splitted_docs, ids=ids)
+    # Embedded Qdrant has no locking, so concurrent upserts could corrupt the collection
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY if QDRANT_URL else 1)
+
+    failed = asyncio.Event()
+    added_ids: list[str] = []
+
+    async def add_batch(batch: list[Document], batch_ids: list[str]) -> None:
+        async with semaphore:
+            if failed.is_set():
+                return
+            try:
+                await vector_store.aadd_documents(documents=batch, ids=batch_ids)
+            except Exception:
+                failed.set()
+                raise
+        stored_ids.update(batch_ids)
+        added_ids.extend(batch_ids)
+
+    results = await asyncio.gather(*[
+        add_batch(splitted_docs[i:i + UPLOAD_BATCH_SIZE], ids[i:i + UPLOAD_BATCH_SIZE])
+        for i in range(0, len(splitted_docs), UPLOAD_BATCH_SIZE)
+    ], return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        logger.error("Failed to add documents to vector store, rolling back %d added chunks.", len(added_ids))
+        if not await rollback_store(vector_store, added_ids, stored_ids):
+            raise RuntimeError(
+                f"{errors[0]} ({len(added_ids)} already added chunks remain in the vector store until RESET)"
+            ) from errors[0]
+        raise errors[0]
     logger.info("Documents successfully added to vector store.")
 
-    return {ids[i]: splitted_docs[i] for i in range(len(ids))}
+    return dict(zip(ids, splitted_docs))
+
+
+async def rollback_store(vector_store: QdrantVectorStore, ids: list[str], stored_ids: set[str]) -> bool:
+    """Delete the chunks of a failed upload, returning whether they are gone from the vector store."""
+    if not ids:
+        return True
+    try:
+        if await vector_store.adelete(ids=ids):
+            stored_ids.difference_update(ids)
+            logger.info("Rolled back %d chunks of the failed upload.", len(ids))
+            return True
+        logger.error("Failed to roll back the failed upload.")
+    except Exception as e:
+        logger.error("Error while rolling back the failed upload: %s", e)
+    return False
+
+
+def format_context(docs: list[Document], doc_char_limit: int = 1500, total_char_limit: int = 6000) -> str:
+    """Build a compact prompt context from the documents' text, dropping the lowest-ranked ones past the budget."""
+    parts: list[str] = []
+    total = 0
+    for doc in docs:
+        content = doc.page_content[:doc_char_limit]
+        if parts and total + len(content) > total_char_limit:
+            break
+        parts.append(content)
+        total += len(content)
+    return "\n\n---\n\n".join(parts)
 
 
 def configure_retriever(
     vector_store: QdrantVectorStore,
-    search_type: str = "mmr",
-    search_kwargs: dict[str, Any] = {"k": 5}
+    search_type: str = "similarity",
+    search_kwargs: dict[str, Any] = RETRIEVER_SEARCH_KWARGS
 ):
     """Configure and return a retriever for the vector store."""
     logger.info("Configuring retriever with search type: %s and search kwargs: %s", search_type, search_kwargs)
@@ -94,18 +184,13 @@ async def cleanup_file(file_path: Path) -> None:
 
 def restrict_to_user_id(func):  # type: ignore
     """Decorator to restrict access to a specific user ID."""
-    AUTHORIZED_USER_ID = os.getenv("ALLOWED_USER_ID")
-    if not AUTHORIZED_USER_ID:
-        logger.error("ALLOWED_USER_ID environment variable is not set.")
-        raise ValueError("ALLOWED_USER_ID environment variable is not set.")
-
     @wraps(func)  # type: ignore
     def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):  # type: ignore
         if not update.effective_user:
             logger.warning("No effective user found in the update.")
             return
 
-        if str(update.effective_user.id) != AUTHORIZED_USER_ID:
+        if update.effective_user.id != AUTHORIZED_USER_ID:
             logger.warning("Unauthorized access attempt by user: %s", update.effective_user.id)
             return
 